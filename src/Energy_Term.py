@@ -1,5 +1,6 @@
 import abc
 import numpy as np
+from numba import njit, prange
 
 
 mu0 = 4 * np.pi * 1e-7
@@ -16,7 +17,27 @@ class EnergyTerm(abc.ABC):
     def effective_field(self, m):
         pass
 
-    def energy_density(self, m):
+    @staticmethod
+    def _saturation(m):
+        '''
+        The function returns the saturation magnetization to scale with,
+        a float when it is uniform and an array otherwise.
+
+        Parameters
+        ----------
+        m : numpy.ndarray
+            the magnetization field class of the system
+
+        Returns
+        -------
+        float or numpy.ndarray
+            saturation magnetization of the system
+
+        '''
+        Ms = m.get_Ms_scalar()
+        return m.get_Ms() if Ms is None else Ms
+
+    def energy_density(self, m, H_eff=None, out=None):
         '''
         The function is the uniform formula to calculate energy density.
 
@@ -24,6 +45,10 @@ class EnergyTerm(abc.ABC):
         ----------
         m : numpy.ndarray
             the magnetization field class of the system
+        H_eff : numpy.ndarray, optional
+            the effective field of this term if it is already computed
+        out : numpy.ndarray, optional
+            array of shape (Nx, Ny, Nz, 1) to write the result into
 
         Returns
         -------
@@ -31,11 +56,15 @@ class EnergyTerm(abc.ABC):
             the energy density of the system
 
         '''
-        value1 = np.multiply(m.get_m(), self.effective_field(m))
-        value2 = np.multiply(m.get_Ms(), value1)
-        return -mu0 / 2 * np.sum(value2, axis=3, keepdims=True)
-
-    def energy(self, m):
+        if H_eff is None:
+            H_eff = self.effective_field(m)
+        # m . H_eff of every cell in a single reduction
+        value = np.einsum('ijkl,ijkl->ijk', m.get_m(), H_eff,
+                          out=None if out is None else out[..., 0])
+        out = np.multiply(self._saturation(m), value[..., None], out=out)
+        return np.multiply(-mu0 / 2, out, out=out)
+
+    def energy(self, m, H_eff=None, out=None):
         '''
         The function is the uniform formula to calculate energy.
 
@@ -43,6 +72,10 @@ class EnergyTerm(abc.ABC):
         ----------
         m : numpy.ndarray
             the magnetization field class of the system
+        H_eff : numpy.ndarray, optional
+            the effective field of this term if it is already computed
+        out : numpy.ndarray, optional
+            scratch array of shape (Nx, Ny, Nz, 1) for the energy density
 
         Returns
         -------
@@ -51,13 +84,17 @@ class EnergyTerm(abc.ABC):
 
         '''
         dV = dx * dy * dz
-        return np.sum(self.energy_density(m) * dV)
+        return np.sum(self.energy_density(m, H_eff, out)) * dV
 
 
 # It calculates the effective field due to exchange interactions
 class Exchange(EnergyTerm):
-    def __init__(self, A):
+    def __init__(self, A, Ms=None):
         self.A = A
+        # The field coefficient is cached for the last uniform
+        # saturation magnetization, Ms gives the expected value
+        self._Ms = Ms
+        self._coef = None if Ms is None else (2 * A) / (mu0 * Ms)
 
     def effective_field(self, m):
         '''
@@ -75,16 +112,27 @@ class Exchange(EnergyTerm):
             effective field of exchange energy
 
         '''
-        if (np.allclose(m.get_M(), 0)):
+        if m.is_zero():
             # zero magnetization has zero effective field
             return np.zeros_like(m.get_M())
-        else:
-            return np.multiply((2 * self.A) / (mu0 * m.get_Ms()), m.laplace())
+        Ms = m.get_Ms_scalar()
+        if Ms is None:
+            # Ms changes between cells
+            Ms = m.get_Ms()
+            return np.multiply((2 * self.A) / (mu0 * Ms), m.laplace())
+        if Ms != self._Ms:
+            # The field follows the Ms of m, not the given one
+            self._Ms, self._coef = Ms, (2 * self.A) / (mu0 * Ms)
+        return np.multiply(self._coef, m.laplace())
 
 
 class DMI(EnergyTerm):
-    def __init__(self, D):
+    def __init__(self, D, Ms=None):
         self.D = D
+        # The field coefficient is cached for the last uniform
+        # saturation magnetization, Ms gives the expected value
+        self._Ms = Ms
+        self._coef = None if Ms is None else -((2 * D) / (mu0 * Ms))
 
     def effective_field(self, m):
         '''
@@ -102,16 +150,26 @@ class DMI(EnergyTerm):
             effective field of DMI energy
 
         '''
-        if (np.allclose(m.get_M(), 0)):
+        if m.is_zero():
             # zero magnetization has zero effective field
             return np.zeros_like(m.get_M())
-        else:
-            return np.multiply(-((2 * self.D) / (mu0 * m.get_Ms())), m.curl())
+        Ms = m.get_Ms_scalar()
+        if Ms is None:
+            # Ms changes between cells
+            Ms = m.get_Ms()
+            return np.multiply(-((2 * self.D) / (mu0 * Ms)), m.curl())
+        if Ms != self._Ms:
+            # The field follows the Ms of m, not the given one
+            self._Ms, self._coef = Ms, -((2 * self.D) / (mu0 * Ms))
+        return np.multiply(self._coef, m.curl())
 
 
 class Zeeman(EnergyTerm):
     def __init__(self, H):
         self.H = H
+        # The external field is constant, so it is stored once
+        # in a shape that broadcasts against the magnetization field
+        self._H = np.asarray(H, dtype=np.float64).reshape((1, 1, 1, 3))
 
     def effective_field(self, m):
         '''
@@ -130,17 +188,24 @@ class Zeeman(EnergyTerm):
 
         '''
         # The shape of the effective field should be same as
-        # magnetization field.
-        return np.tile(self.H, Nx * Ny * Nz).reshape((Nx, Ny, Nz, 3))
+        # magnetization field. It is a read-only broadcast view.
+        M = m.get_M()
+        return np.broadcast_to(self._H.astype(M.dtype, copy=False), M.shape)
 
-    def energy_density(self, m):
+    def energy_density(self, m, H_eff=None, out=None):
         '''
         The function calcualtes the energy density of zeeman energy term.
 
+        The external field is constant, so H_eff is not needed.
+
         Parameters
         ----------
         m : numpy.ndarray
             the magnetization field class of the system
+        H_eff : numpy.ndarray, optional
+            unused, kept for the common interface of energy terms
+        out : numpy.ndarray, optional
+            array of shape (Nx, Ny, Nz, 1) to write the result into
 
         Returns
         -------
@@ -148,13 +213,190 @@ class Zeeman(EnergyTerm):
             effective field of zeeman energy
 
         '''
-        value = np.multiply(m.get_m(), self.effective_field(m))
-        return -mu0 * m.get_Ms() * np.sum(value, axis=3, keepdims=True)
+        H = self._H.astype(m.get_M().dtype, copy=False).reshape(3)
+        value = np.einsum('ijkl,l->ijk', m.get_m(), H,
+                          out=None if out is None else out[..., 0])
+        out = np.multiply(self._saturation(m), value[..., None], out=out)
+        return np.multiply(-mu0, out, out=out)
+
+
+@njit(parallel=True, fastmath=True)
+def _curl_kernel(m, out, inv2dx, inv2dy, inv2dz):
+    '''
+    Single-pass curl stencil of the unit magnetization field.
+
+    Dirichlet boundary condition is applied inline, which means
+    neighbours outside the mesh are zero. The result is written into out.
+
+    Parameters
+    ----------
+    m : numpy.ndarray
+        unit magnetization field with shape (3, Nx, Ny, Nz)
+    out : numpy.ndarray
+        output array with the same shape as m
+    inv2dx, inv2dy, inv2dz : float
+        reciprocals of twice the cell distances
+
+    '''
+    nx, ny, nz = m.shape[1], m.shape[2], m.shape[3]
+    # zero in the working precision of m
+    zero = m.dtype.type(0)
+    for i in prange(nx):
+        for j in range(ny):
+            for k in range(nz):
+                # Neighbours along x
+                my_ip = m[1, i + 1, j, k] if i + 1 < nx else zero
+                mz_ip = m[2, i + 1, j, k] if i + 1 < nx else zero
+                my_im = m[1, i - 1, j, k] if i > 0 else zero
+                mz_im = m[2, i - 1, j, k] if i > 0 else zero
+                # Neighbours along y
+                mx_jp = m[0, i, j + 1, k] if j + 1 < ny else zero
+                mz_jp = m[2, i, j + 1, k] if j + 1 < ny else zero
+                mx_jm = m[0, i, j - 1, k] if j > 0 else zero
+                mz_jm = m[2, i, j - 1, k] if j > 0 else zero
+                # Neighbours along z
+                mx_kp = m[0, i, j, k + 1] if k + 1 < nz else zero
+                my_kp = m[1, i, j, k + 1] if k + 1 < nz else zero
+                mx_km = m[0, i, j, k - 1] if k > 0 else zero
+                my_km = m[1, i, j, k - 1] if k > 0 else zero
+
+                dzdy = (mz_jp - mz_jm) * inv2dy
+                dydz = (my_kp - my_km) * inv2dz
+                dxdz = (mx_kp - mx_km) * inv2dz
+                dzdx = (mz_ip - mz_im) * inv2dx
+                dxdy = (mx_jp - mx_jm) * inv2dy
+                dydx = (my_ip - my_im) * inv2dx
+
+                # Set the x, y, z term of curl using curl's formula
+                out[0, i, j, k] = dzdy - dydz
+                out[1, i, j, k] = dxdz - dzdx
+                out[2, i, j, k] = dydx - dxdy
+
+
+@njit(inline='always', fastmath=True)
+def _lap_point(m, out, c, i, j, k, im, ip, jm, jp, km, kp, ix2, iy2, iz2):
+    '''
+    7-point Laplacian of component c at one cell from its neighbour indices.
+    '''
+    mc2 = 2 * m[c, i, j, k]
+    out[c, i, j, k] = (
+        (m[c, im, j, k] + m[c, ip, j, k] - mc2) * ix2 +
+        (m[c, i, jm, k] + m[c, i, jp, k] - mc2) * iy2 +
+        (m[c, i, j, km] + m[c, i, j, kp] - mc2) * iz2)
+
+
+@njit(parallel=True, fastmath=True)
+def _lap_kernel(m, out, ix2, iy2, iz2):
+    '''
+    Single-pass 7-point Laplacian stencil of the unit magnetization field.
+
+    Neumann boundary condition (dm/dn = 0) is applied inline by clamping
+    the neighbour indices, which means ghost items are equal to the
+    boundary terms. The z faces are handled after the interior loop.
+    The result is written into out.
+
+    Parameters
+    ----------
+    m : numpy.ndarray
+        unit magnetization field with shape (3, Nx, Ny, Nz)
+    out : numpy.ndarray
+        output array with the same shape as m
+    ix2, iy2, iz2 : float
+        reciprocals of the squared cell distances
+
+    '''
+    nx, ny, nz = m.shape[1], m.shape[2], m.shape[3]
+    for i in prange(nx):
+        im = i - 1 if i > 0 else 0
+        ip = i + 1 if i < nx - 1 else nx - 1
+        # Each component is a separate volume with unit stride along z
+        for c in range(3):
+            for j in range(ny):
+                jm = j - 1 if j > 0 else 0
+                jp = j + 1 if j < ny - 1 else ny - 1
+                # Interior along z needs no clamping, so the
+                # unit-stride loop is free of boundary branches
+                for k in range(1, nz - 1):
+                    _lap_point(m, out, c, i, j, k, im, ip, jm, jp,
+                               k - 1, k + 1, ix2, iy2, iz2)
+                # Neumann boundary faces along z
+                for k in (0, nz - 1):
+                    km = k - 1 if k > 0 else 0
+                    kp = k + 1 if k < nz - 1 else nz - 1
+                    _lap_point(m, out, c, i, j, k, im, ip, jm, jp,
+                               km, kp, ix2, iy2, iz2)
+
+
+@njit(parallel=True, fastmath=True)
+def _curl_kernel_aos(m, out, inv2dx, inv2dy, inv2dz):
+    '''
+    Curl stencil of _curl_kernel for fields with shape (Nx, Ny, Nz, 3),
+    used by M.curl so the field is not copied to component-first order.
+    '''
+    nx, ny, nz = m.shape[0], m.shape[1], m.shape[2]
+    # zero in the working precision of m
+    zero = m.dtype.type(0)
+    for i in prange(nx):
+        for j in range(ny):
+            for k in range(nz):
+                # Dirichlet boundary condition, outside neighbours are zero
+                my_ip = m[i + 1, j, k, 1] if i + 1 < nx else zero
+                mz_ip = m[i + 1, j, k, 2] if i + 1 < nx else zero
+                my_im = m[i - 1, j, k, 1] if i > 0 else zero
+                mz_im = m[i - 1, j, k, 2] if i > 0 else zero
+                mx_jp = m[i, j + 1, k, 0] if j + 1 < ny else zero
+                mz_jp = m[i, j + 1, k, 2] if j + 1 < ny else zero
+                mx_jm = m[i, j - 1, k, 0] if j > 0 else zero
+                mz_jm = m[i, j - 1, k, 2] if j > 0 else zero
+                mx_kp = m[i, j, k + 1, 0] if k + 1 < nz else zero
+                my_kp = m[i, j, k + 1, 1] if k + 1 < nz else zero
+                mx_km = m[i, j, k - 1, 0] if k > 0 else zero
+                my_km = m[i, j, k - 1, 1] if k > 0 else zero
+                out[i, j, k, 0] = ((mz_jp - mz_jm) * inv2dy -
+                                   (my_kp - my_km) * inv2dz)
+                out[i, j, k, 1] = ((mx_kp - mx_km) * inv2dz -
+                                   (mz_ip - mz_im) * inv2dx)
+                out[i, j, k, 2] = ((my_ip - my_im) * inv2dx -
+                                   (mx_jp - mx_jm) * inv2dy)
+
+
+@njit(parallel=True, fastmath=True)
+def _lap_kernel_aos(m, out, ix2, iy2, iz2):
+    '''
+    Laplacian stencil of _lap_kernel for fields with shape (Nx, Ny, Nz, 3),
+    used by M.laplace so the field is not copied to component-first order.
+    '''
+    nx, ny, nz = m.shape[0], m.shape[1], m.shape[2]
+    for i in prange(nx):
+        im = i - 1 if i > 0 else 0
+        ip = i + 1 if i < nx - 1 else nx - 1
+        for j in range(ny):
+            jm = j - 1 if j > 0 else 0
+            jp = j + 1 if j < ny - 1 else ny - 1
+            for k in range(nz):
+                # Neumann boundary condition by clamping
+                km = k - 1 if k > 0 else 0
+                kp = k + 1 if k < nz - 1 else nz - 1
+                for c in range(3):
+                    mc2 = 2 * m[i, j, k, c]
+                    out[i, j, k, c] = (
+                        (m[im, j, k, c] + m[ip, j, k, c] - mc2) * ix2 +
+                        (m[i, jm, k, c] + m[i, jp, k, c] - mc2) * iy2 +
+                        (m[i, j, km, c] + m[i, j, kp, c] - mc2) * iz2)
 
 
 class M:
-    def __init__(self, M):
-        self.M = M
+    def __init__(self, M, dtype=np.float64):
+        # Working precision of the field, np.float32 halves the memory
+        # traffic of the stencils at the cost of precision
+        self.dtype = np.dtype(dtype)
+        self.M = np.asarray(M, dtype=self.dtype)
+        self._is_zero = not np.any(self.M)
+        # Ms and m are computed lazily and cached until M is set again
+        self._Ms = None
+        self._m = None
+        self._Ms_uniform = None
+        self._Ms_scalar = None
 
     def get_M(self):
         '''
@@ -180,36 +422,89 @@ class M:
         '''
         # saturation magnetization is the norm of M
         # The shape is (Nx, Ny, Nz, 1)
-        Ms = np.expand_dims(np.linalg.norm(self.M, axis=3), axis=3)
-        return Ms
+        if self._Ms is None:
+            self._Ms = np.linalg.norm(self.M, axis=3, keepdims=True)
+            # read-only, so the cache only changes through set_M
+            self._Ms.setflags(write=False)
+        return self._Ms
+
+    def get_Ms_scalar(self):
+        '''
+        This function returns the saturation magnetization as a float
+        if it is uniform over the field.
+
+        Returns
+        -------
+        float or None
+            uniform saturation magnetization,
+            None if it changes between cells
+
+        '''
+        if self._Ms_uniform is None:
+            Ms = self.get_Ms()
+            Ms_max = Ms.max()
+            # Norms of a uniform field differ by round-off,
+            # which depends on the working precision
+            eps = np.finfo(self.dtype).eps
+            self._Ms_uniform = Ms_max - Ms.min() <= 16 * eps * Ms_max
+            self._Ms_scalar = float(Ms.flat[0])
+        return self._Ms_scalar if self._Ms_uniform else None
+
+    def is_zero(self):
+        '''
+        This function returns whether the magnetization field is zero.
+
+        Returns
+        -------
+        bool
+            True if every component of M is zero
+
+        '''
+        return self._is_zero
 
     def get_m(self):
         '''
         This function returns the unit magnetization vector field.
 
+        m is computed once and cached until M is set again, so
+        a copy is needed to keep the old m after set_M.
+
         Returns
         -------
         numpy.ndarray
-            lowercase m of magnetization field
+            lowercase m of magnetization field, read-only
 
         '''
-        if (np.allclose(self.get_M(), 0)):
-            # zero magnetization has zero m
-            return np.zeros_like(self.get_M())
-        else:
-            return self.M / self.get_Ms()
+        if self._m is None:
+            if self.is_zero():
+                # zero magnetization has zero m
+                self._m = np.zeros_like(self.get_M())
+            else:
+                self._m = self.M / self.get_Ms()
+            # The energy terms share this array, it is read-only so
+            # the cache only changes through set_M
+            self._m.setflags(write=False)
+        return self._m
 
     def set_M(self, M_new):
         '''
         The function sets the value of the M.
 
+        The cached Ms and m are cleared, so M should always be
+        changed through this function.
+
         Parameters
         ----------
         M_new
-            the new value of M
+            the new value of M, cast to the working precision
 
         '''
-        self.M = M_new
+        self.M = np.asarray(M_new, dtype=self.dtype)
+        self._is_zero = not np.any(self.M)
+        self._Ms = None
+        self._m = None
+        self._Ms_uniform = None
+        self._Ms_scalar = None
 
     def curl(self):
         '''
@@ -227,43 +522,12 @@ class M:
             The curl of the magnetization vector field.
 
         '''
-        curl = np.zeros_like(self.get_m())
-
-        dzdy = np.zeros((Nx, Ny, Nz))
-        dydz = np.zeros((Nx, Ny, Nz))
-        dxdz = np.zeros((Nx, Ny, Nz))
-        dzdx = np.zeros((Nx, Ny, Nz))
-        dxdy = np.zeros((Nx, Ny, Nz))
-        dydx = np.zeros((Nx, Ny, Nz))
-
-        # Dirichlet boundary condition
-        # which means ghost items are zero.
-        m_pad = np.pad(
-            self.get_m(), ((1, 1), (1, 1), (1, 1), (0, 0)), 'constant',
-            constant_values=((0, 0), (0, 0), (0, 0), (0, 0)))
-
+        m = self.get_m()
+        curl = np.empty_like(m)
+        t = self.dtype.type
         # First-order central difference has been used
-        dzdy[...] += (m_pad[1:-1, 2:, 1:-1, 2] -
-                      m_pad[1:-1, :-2, 1:-1, 2]) / (2 * dy)
-
-        dydz[...] += (m_pad[1:-1, 1:-1, 2:, 1] -
-                      m_pad[1:-1, 1:-1, :-2, 1]) / (2 * dz)
-
-        dxdz[...] += (m_pad[1:-1, 1:-1, 2:, 0] -
-                      m_pad[1:-1, 1:-1, :-2, 0]) / (2 * dz)
-
-        dzdx[...] += (m_pad[2:, 1:-1, 1:-1, 2] -
-                      m_pad[:-2, 1:-1, 1:-1, 2]) / (2 * dx)
-
-        dxdy[...] += (m_pad[1:-1, 2:, 1:-1, 0] -
-                      m_pad[1:-1, :-2, 1:-1, 0]) / (2 * dy)
-        dydx[...] += (m_pad[2:, 1:-1, 1:-1, 1] -
-                      m_pad[:-2, 1:-1, 1:-1, 1]) / (2 * dx)
-
-        # Set the x, y, z term of curl using curl's formula
-        curl[..., 0] += dzdy - dydz
-        curl[..., 1] += dxdz - dzdx
-        curl[..., 2] += dydx - dxdy
+        _curl_kernel_aos(m, curl, t(1 / (2 * dx)), t(1 / (2 * dy)),
+                         t(1 / (2 * dz)))
         return curl
 
     def laplace(self):
@@ -280,16 +544,10 @@ class M:
                 The Laplacian of the magnetisation field.
 
         '''
-        lap = np.zeros_like(self.get_m())
-        # Neumann boundary condition: dm/dn = 0
-        # which means ghost items are equal to the boundary terms.
-        m_pad = np.pad(self.get_m(), ((1, 1), (1, 1), (1, 1), (0, 0)), 'edge')
+        m = self.get_m()
+        lap = np.empty_like(m)
+        t = self.dtype.type
         # Second-Order Central Difference has been used.
-        # Vectorisation
-        lap += (m_pad[0:-2, 1:-1, 1:-1] + m_pad[2:, 1:-1, 1:-1] -
-                2 * m_pad[1:-1, 1:-1, 1:-1]) / (dx ** 2)
-        lap += (m_pad[1:-1, 0:-2, 1:-1] + m_pad[1:-1, 2:, 1:-1] -
-                2 * m_pad[1:-1, 1:-1, 1:-1]) / (dy ** 2)
-        lap += (m_pad[1:-1, 1:-1, 0:-2] + m_pad[1:-1, 1:-1, 2:] -
-                2 * m_pad[1:-1, 1:-1, 1:-1]) / (dz ** 2)
+        _lap_kernel_aos(m, lap, t(1 / dx ** 2), t(1 / dy ** 2),
+                        t(1 / dz ** 2))
         return lap
@@ -1,5 +1,9 @@
 from src.Energy_Term import Exchange, Zeeman, DMI
+from src.Energy_Term import _lap_kernel, _curl_kernel, dx, dy, dz
+from src.Mean_Field_CUDA import _mean_field_cuda
+import math
 import numpy as np
+from numba import njit, prange, vectorize
 
 # Some important hyperparameters
 beta = 9e99  # 9e99 represents positive infinity
@@ -9,9 +13,201 @@ B = 0.2  # External magnetic field strength
 mu0 = 4 * np.pi * 1e-7
 H = (0, 0, B / mu0)
 maxiter = 12000
+check_interval = 64  # iterations between convergence checks, a power of 2
+
+
+@vectorize(['float32(float32)', 'float64(float64)'], cache=True)
+def _langevin(x):
+    '''
+    Langevin function as a ufunc, usable on arrays and
+    inside the compiled mean-field loop.
+    '''
+    if abs(x) < 1e-4:
+        # Taylor expansion, coth(x) and 1/x cancel for small x
+        return x / 3 - x ** 3 / 45
+    if abs(x) > 20:
+        # coth(x) equals sign(x) to double precision
+        return math.copysign(1.0, x) - 1 / x
+    return (1 / math.tanh(x)) - 1 / x
+
+
+@njit(parallel=True, fastmath=True)
+def _update_kernel(M, m, Ms, H_eff, beta, lamda, check):
+    '''
+    Update M in place from the effective field, then refresh the
+    unit magnetization m and the saturation magnetization Ms.
+
+    Returns
+    -------
+    float
+        The largest absolute change of m if check is True, otherwise 0.
+    '''
+    nx, ny, nz = M.shape[1], M.shape[2], M.shape[3]
+    # Constants in the working precision of M
+    t = M.dtype.type
+    zero, lam = t(0), t(lamda)
+    max_diff = zero
+    for i in prange(nx):
+        local = zero
+        for j in range(ny):
+            for k in range(nz):
+                Hx, Hy, Hz = H_eff[0, i, j, k], H_eff[1, i, j, k], \
+                    H_eff[2, i, j, k]
+                H_norm = np.sqrt(Hx * Hx + Hy * Hy + Hz * Hz)
+                # Zero effective field means M should not change
+                if H_norm > 0:
+                    # No Temperature (T = 0, beta = inf)
+                    if beta == 9e99:
+                        L_result = t(1)
+                    else:
+                        L_result = t(_langevin(beta * mu0 * H_norm))
+                    # Ms * Langevin(x) * (H_eff / |H_eff|)
+                    scale = Ms[i, j, k] * L_result / H_norm
+                    # Calculate new direction of magnetization field
+                    Mx = M[0, i, j, k] + lam * (scale * Hx - M[0, i, j, k])
+                    My = M[1, i, j, k] + lam * (scale * Hy - M[1, i, j, k])
+                    Mz = M[2, i, j, k] + lam * (scale * Hz - M[2, i, j, k])
+                    # Renormalization to the norm of Ms * Langevin(x)
+                    ratio = Ms[i, j, k] * abs(L_result) / \
+                        np.sqrt(Mx * Mx + My * My + Mz * Mz)
+                    M[0, i, j, k] = Mx * ratio
+                    M[1, i, j, k] = My * ratio
+                    M[2, i, j, k] = Mz * ratio
+                # Refresh Ms, m and track the change of m
+                Ms_new = np.sqrt(M[0, i, j, k] ** 2 + M[1, i, j, k] ** 2 +
+                                 M[2, i, j, k] ** 2)
+                Ms[i, j, k] = Ms_new
+                for c in range(3):
+                    m_new = M[c, i, j, k] / Ms_new if Ms_new > 0 else zero
+                    if check:
+                        local = max(local, abs(m_new - m[c, i, j, k]))
+                    m[c, i, j, k] = m_new
+        # parallel max reduction over the x index
+        max_diff = max(max_diff, local)
+    return max_diff
+
+
+@njit(parallel=True, fastmath=True)
+def _field_kernel(m, Ms, H, A, D, lap, curl, H_eff):
+    '''
+    Combine the exchange, DMI and zeeman effective fields into H_eff.
+    '''
+    # Constants in the working precision of m
+    t = m.dtype.type
+    _lap_kernel(m, lap, t(1 / dx ** 2), t(1 / dy ** 2), t(1 / dz ** 2))
+    _curl_kernel(m, curl, t(1 / (2 * dx)), t(1 / (2 * dy)), t(1 / (2 * dz)))
+    ex, dmi, zero = t((2 * A) / mu0), t(-((2 * D) / mu0)), t(0)
+    nx, ny, nz = m.shape[1], m.shape[2], m.shape[3]
+    for i in prange(nx):
+        for j in range(ny):
+            for k in range(nz):
+                # zero magnetization has zero exchange and DMI field
+                if Ms[i, j, k] > 0:
+                    coef_ex = ex / Ms[i, j, k]
+                    coef_dmi = dmi / Ms[i, j, k]
+                else:
+                    coef_ex = zero
+                    coef_dmi = zero
+                for c in range(3):
+                    H_eff[c, i, j, k] = (coef_ex * lap[c, i, j, k] +
+                                         coef_dmi * curl[c, i, j, k] + H[c])
+
+
+@njit
+def _mean_field(M, H, A, D, beta, lamda, tol, maxiter, check_mask):
+    '''
+    Compiled mean-field iteration operating on the raw array M in place.
+
+    All fields are stored component-first with shape (3, Nx, Ny, Nz),
+    so each component is a contiguous volume for the stencils.
+
+    The stopping criteria is only evaluated when count & check_mask is 0.
+
+    Returns
+    -------
+    int
+        Number of iterations.
+    '''
+    nx, ny, nz = M.shape[1], M.shape[2], M.shape[3]
+    Ms = np.empty((nx, ny, nz), M.dtype)
+    m = np.empty_like(M)
+    lap = np.empty_like(M)
+    curl = np.empty_like(M)
+    H_eff = np.empty_like(M)
+    for i in range(nx):
+        for j in range(ny):
+            for k in range(nz):
+                Ms[i, j, k] = np.sqrt(M[0, i, j, k] ** 2 +
+                                      M[1, i, j, k] ** 2 +
+                                      M[2, i, j, k] ** 2)
+                for c in range(3):
+                    m[c, i, j, k] = M[c, i, j, k] / Ms[i, j, k] \
+                        if Ms[i, j, k] > 0 else M.dtype.type(0)
+    _field_kernel(m, Ms, H, A, D, lap, curl, H_eff)
+
+    count = 0
+    while count < maxiter:
+        # update M, m and Ms
+        check = (count & check_mask) == 0
+        max_value = _update_kernel(M, m, Ms, H_eff, beta, lamda, check)
+        _field_kernel(m, Ms, H, A, D, lap, curl, H_eff)
+        # stop criteria
+        if check and max_value <= tol:
+            break
+        count += 1
+        if (count % 1000 == 0):
+            print(count)
+    return count
+
+
+def _norm(x, out):
+    '''
+    Norm of x over the vector axis, written into out of shape (Nx, Ny, Nz, 1).
+    '''
+    np.einsum('ijkl,ijkl->ijk', x, x, out=out[..., 0])
+    return np.sqrt(out, out=out)
 
 
 class Min_Driver:
+    def __init__(self, A=A, D=D, H=H, device='cpu'):
+        # The iteration runs on the CPU or on a CUDA device
+        if device not in ('cpu', 'cuda'):
+            raise ValueError("device should be 'cpu' or 'cuda'")
+        self.device = device
+        # Define energy terms exchange, zeeman and dmi once
+        self.exchange = Exchange(A=A)
+        self.zeeman = Zeeman(H=H)
+        self.dmi = DMI(D=D)
+        # Scratch buffers of update_M, allocated for the first M shape
+        self._H_norm = None
+        self._M_lamda = None
+        self._Mnew_norm = None
+        self._Mlam_norm = None
+        # Scratch buffer of the energy density
+        self._scratch = None
+
+    def _alloc_buffers(self, shape, dtype):
+        '''
+        The function allocates the scratch buffers of update_M and
+        the energy density when they do not exist or have a different
+        shape or precision.
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of the magnetization field (Nx, Ny, Nz, 3)
+        dtype : numpy.dtype
+            working precision of the magnetization field
+
+        '''
+        if (self._M_lamda is None or self._M_lamda.shape != shape or
+                self._M_lamda.dtype != dtype):
+            self._H_norm = np.empty(shape[:3] + (1,), dtype)
+            self._M_lamda = np.empty(shape, dtype)
+            self._Mnew_norm = np.empty(shape[:3] + (1,), dtype)
+            self._Mlam_norm = np.empty(shape[:3] + (1,), dtype)
+            self._scratch = np.empty(shape[:3] + (1,), dtype)
+
     def Langevin(self, x):
         """
         The function calculates the value of the Langevin function
@@ -34,7 +230,9 @@ class Min_Driver:
         >>> min_driver.Langevin(x)
         [[0.313035],[0.313035],[0.313035]]
         """
-        return (1 / np.tanh(x)) - x ** (-1)
+        # The expression is stable for small x, where 1 / tanh(x) - 1 / x
+        # loses precision, and Langevin(0) is 0
+        return _langevin(x)
 
     def cal_effective_field(self, m):
         '''
@@ -53,23 +251,46 @@ class Min_Driver:
             The energy of m.
 
         '''
-        # Define energy terms exchange, zeeman and dmi
-        exchange = Exchange(A=A)
-        zeeman = Zeeman(H=H)
-        dmi = DMI(D=D)
         # Calculate the effective field of energy terms
-        Heff_ex_my = exchange.effective_field(m)
-        Heff_z_my = zeeman.effective_field(m)
-        Heff_dmi_my = dmi.effective_field(m)
-        H_eff = Heff_ex_my + Heff_z_my + Heff_dmi_my
-
-        # Calculate the energy of energy terms
-        E_ex = exchange.energy(m)
-        E_z = zeeman.energy(m)
-        E_dmi = dmi.energy(m)
+        Heff_ex_my = self.exchange.effective_field(m)
+        Heff_z_my = self.zeeman.effective_field(m)
+        Heff_dmi_my = self.dmi.effective_field(m)
+
+        # Calculate the energy of energy terms from the fields above
+        self._alloc_buffers(m.get_M().shape, m.get_M().dtype)
+        E_ex = self.exchange.energy(m, Heff_ex_my, self._scratch)
+        E_z = self.zeeman.energy(m, Heff_z_my, self._scratch)
+        E_dmi = self.dmi.energy(m, Heff_dmi_my, self._scratch)
         E = E_ex + E_z + E_dmi
+
+        # Sum the fields into the exchange field, which is a new array
+        # of this call, instead of allocating intermediate sums
+        H_eff = np.add(Heff_ex_my, Heff_dmi_my, out=Heff_ex_my)
+        np.add(H_eff, Heff_z_my, out=H_eff)
         return H_eff, E
 
+    def cal_energy(self, m):
+        '''
+        The function calculates the energy of the system
+        without summing the effective field.
+
+        Parameters
+        ----------
+        m : numpy.ndarray
+            the magnetization field class of the system
+
+        Returns
+        -------
+        float
+            The energy of m.
+
+        '''
+        self._alloc_buffers(m.get_M().shape, m.get_M().dtype)
+        E_ex = self.exchange.energy(m, out=self._scratch)
+        E_z = self.zeeman.energy(m, out=self._scratch)
+        E_dmi = self.dmi.energy(m, out=self._scratch)
+        return E_ex + E_z + E_dmi
+
     def update_M(self, m, H_eff, lamda=0.005):
         '''
         The function is used to update the magnetization field,
@@ -92,9 +313,10 @@ class Min_Driver:
         '''
         M_old = m.get_M()
         Ms_old = m.get_Ms()
+        self._alloc_buffers(M_old.shape, M_old.dtype)
         # The norm of effective field
         # The shape should be (Nx, Ny, Nz, 1)
-        H_norm = np.expand_dims(np.linalg.norm(H_eff, axis=3), axis=3)
+        H_norm = _norm(H_eff, self._H_norm)
         # No Temperature (T = 0, beta = inf)
         if beta == 9e99:
             # Limitation of Langevin(x->positive infinity) is 1
@@ -105,23 +327,28 @@ class Min_Driver:
             L_result = self.Langevin(x)
         # Effective field equals to 0 means the system
         # already in the final state, M should not change
-        if (np.allclose(H_norm, 0)):
+        if not H_norm.any():
             M_new = M_old
         else:
             # Calculate new magnitude of magnetization field
             # Ms * Langevin(x) * (H_eff / |H_eff|)
-            M_new = np.multiply(
-                Ms_old, np.multiply(
-                    L_result, (H_eff / H_norm)))
+            M_new = np.divide(H_eff, H_norm, dtype=M_old.dtype)
+            if beta != 9e99:
+                np.multiply(M_new, L_result, out=M_new)
+            np.multiply(M_new, Ms_old, out=M_new)
             # Calculate new direction of magnetization field
-            M_lamda = M_old + lamda * (M_new - M_old)
+            # M_old + lamda * (M_new - M_old)
+            M_lamda = np.subtract(M_new, M_old, out=self._M_lamda)
+            np.multiply(M_lamda, lamda, out=M_lamda)
+            np.add(M_lamda, M_old, out=M_lamda)
             # Calculate norm of new magnetization field to use to renormalize
-            M_new_norm = np.expand_dims(np.linalg.norm(M_new, axis=3), axis=3)
+            M_new_norm = _norm(M_new, self._Mnew_norm)
             # Calculate norm of M_lamda to use to uniform itself
-            M_lamda_norm = np.expand_dims(
-                np.linalg.norm(M_lamda, axis=3), axis=3)
-            # Renormalization
-            M_new = (M_lamda / M_lamda_norm) * M_new_norm
+            M_lamda_norm = _norm(M_lamda, self._Mlam_norm)
+            # Renormalization, M_new is a new array so that
+            # the field class never shares it with the buffers
+            np.divide(M_lamda, M_lamda_norm, out=M_new)
+            np.multiply(M_new, M_new_norm, out=M_new)
 
         return M_new
 
@@ -132,15 +359,19 @@ class Min_Driver:
         The function uses a while loop
         that iterates until the magnetization converges or reach maxiteration.
 
-        The magnetization is updated by calling the update_M function.
+        The iteration runs in a compiled Numba loop on a copy of M,
+        on the CPU or on a CUDA device chosen by the device of the driver,
+        which applies the same update as the update_M function and
+        the same effective field as the cal_effective_field function.
 
-        The effective field and energy are calculated
-        by calling the cal_effective_field function.
+        The energy is calculated once for the final state
+        by calling the cal_energy function.
 
         The magnetization is considered to have converged
         when the difference between the magnetization at the current iteration
         and the magnetization at the previous iteration
         is less than a tolerance value.
+        The difference is only checked every check_interval iterations.
 
         The tolerance value is set to 1e-4 by default.
 
@@ -162,23 +393,17 @@ class Min_Driver:
             Final total energy.
 
         '''
-        count = 0
-        H_eff, E = self.cal_effective_field(m)
-        while count < maxiter:
-            m_old = m.get_m()
-            # update M
-            M_new = self.update_M(m, H_eff)
-            m.set_M(M_new)
-            m_new = m.get_m()
-            H_eff, E = self.cal_effective_field(m)
-            # stop criteria
-            diff = m_new - m_old
-            max_value = np.max(abs(diff))
-            if np.allclose(max_value, 0, atol=tol):
-                break
-            count += 1
-            if (count % 1000 == 0):
-                print(count)
+        # The iteration runs in compiled code on a copy of M,
+        # the energy is only needed for the final state.
+        # The arrays follow the working precision of m,
+        # the kernels cast the constants to it.
+        M_arr = np.array(np.moveaxis(m.get_M(), -1, 0), order='C')
+        H_arr = np.asarray(self.zeeman.H, dtype=M_arr.dtype)
+        driver = _mean_field_cuda if self.device == 'cuda' else _mean_field
+        count = driver(M_arr, H_arr, self.exchange.A, self.dmi.D,
+                       beta, 0.005, tol, maxiter, check_interval - 1)
+        m.set_M(np.moveaxis(M_arr, 0, -1).copy())
+        E = self.cal_energy(m)
 
         print("Number of iteration: ", count)
         return m, E, count
@@ -0,0 +1,217 @@
+import math
+import numpy as np
+from numba import cuda, from_dtype
+from src.Energy_Term import dx, dy, dz
+
+mu0 = 4 * np.pi * 1e-7
+# Threads per block, the shared memory tile adds one halo cell per side
+TX, TY, TZ = (8, 8, 4)
+
+_kernels = {}
+
+
+@cuda.jit(device=True)
+def _langevin(x):
+    '''
+    Scalar Langevin function on the device, stable for small and large x.
+    '''
+    if abs(x) < 1e-4:
+        # Taylor expansion, coth(x) and 1/x cancel for small x
+        return x / 3 - x ** 3 / 45
+    if abs(x) > 20:
+        # coth(x) equals sign(x) to double precision
+        return math.copysign(1.0, x) - 1 / x
+    return (1 / math.tanh(x)) - 1 / x
+
+
+def _get_kernels(dtype):
+    '''
+    The function compiles the device kernels for one working precision,
+    since the shared memory tile needs its type when compiled.
+
+    Parameters
+    ----------
+    dtype : numpy.dtype
+        working precision of the magnetization field
+
+    Returns
+    -------
+    tuple
+        unit, field and update kernels
+
+    '''
+    if dtype in _kernels:
+        return _kernels[dtype]
+    nb_t = from_dtype(dtype)
+
+    @cuda.jit
+    def unit_kernel(M, m, Ms):
+        # Saturation magnetization and unit magnetization of every cell
+        i, j, k = cuda.grid(3)
+        if i >= M.shape[1] or j >= M.shape[2] or k >= M.shape[3]:
+            return
+        Ms_c = math.sqrt(M[0, i, j, k] ** 2 + M[1, i, j, k] ** 2 +
+                         M[2, i, j, k] ** 2)
+        Ms[i, j, k] = Ms_c
+        for c in range(3):
+            m[c, i, j, k] = M[c, i, j, k] / Ms_c if Ms_c > 0 else nb_t(0)
+
+    @cuda.jit
+    def field_kernel(m, Ms, H, ex, dmi, ix2, iy2, iz2, i2dx, i2dy, i2dz,
+                     H_eff):
+        # The block and its face neighbours are staged in shared memory.
+        # Ghost cells hold the clamped boundary values, which is the
+        # Neumann condition of the Laplacian, the curl checks the global
+        # index instead to apply its Dirichlet condition.
+        tile = cuda.shared.array(shape=(3, TX + 2, TY + 2, TZ + 2),
+                                 dtype=nb_t)
+        nx, ny, nz = m.shape[1], m.shape[2], m.shape[3]
+        i, j, k = cuda.grid(3)
+        ti = cuda.threadIdx.x + 1
+        tj = cuda.threadIdx.y + 1
+        tk = cuda.threadIdx.z + 1
+        ic, jc, kc = min(i, nx - 1), min(j, ny - 1), min(k, nz - 1)
+        for c in range(3):
+            tile[c, ti, tj, tk] = m[c, ic, jc, kc]
+            if ti == 1:
+                tile[c, 0, tj, tk] = m[c, max(ic - 1, 0), jc, kc]
+            if ti == TX:
+                tile[c, TX + 1, tj, tk] = m[c, min(ic + 1, nx - 1), jc, kc]
+            if tj == 1:
+                tile[c, ti, 0, tk] = m[c, ic, max(jc - 1, 0), kc]
+            if tj == TY:
+                tile[c, ti, TY + 1, tk] = m[c, ic, min(jc + 1, ny - 1), kc]
+            if tk == 1:
+                tile[c, ti, tj, 0] = m[c, ic, jc, max(kc - 1, 0)]
+            if tk == TZ:
+                tile[c, ti, tj, TZ + 1] = m[c, ic, jc, min(kc + 1, nz - 1)]
+        cuda.syncthreads()
+        if i >= nx or j >= ny or k >= nz:
+            return
+
+        zero = nb_t(0)
+        # Dirichlet boundary condition for the curl
+        my_ip = tile[1, ti + 1, tj, tk] if i + 1 < nx else zero
+        mz_ip = tile[2, ti + 1, tj, tk] if i + 1 < nx else zero
+        my_im = tile[1, ti - 1, tj, tk] if i > 0 else zero
+        mz_im = tile[2, ti - 1, tj, tk] if i > 0 else zero
+        mx_jp = tile[0, ti, tj + 1, tk] if j + 1 < ny else zero
+        mz_jp = tile[2, ti, tj + 1, tk] if j + 1 < ny else zero
+        mx_jm = tile[0, ti, tj - 1, tk] if j > 0 else zero
+        mz_jm = tile[2, ti, tj - 1, tk] if j > 0 else zero
+        mx_kp = tile[0, ti, tj, tk + 1] if k + 1 < nz else zero
+        my_kp = tile[1, ti, tj, tk + 1] if k + 1 < nz else zero
+        mx_km = tile[0, ti, tj, tk - 1] if k > 0 else zero
+        my_km = tile[1, ti, tj, tk - 1] if k > 0 else zero
+        curl_x = (mz_jp - mz_jm) * i2dy - (my_kp - my_km) * i2dz
+        curl_y = (mx_kp - mx_km) * i2dz - (mz_ip - mz_im) * i2dx
+        curl_z = (my_ip - my_im) * i2dx - (mx_jp - mx_jm) * i2dy
+
+        # zero magnetization has zero exchange and DMI field
+        Ms_c = Ms[i, j, k]
+        coef_ex = ex / Ms_c if Ms_c > 0 else zero
+        coef_dmi = dmi / Ms_c if Ms_c > 0 else zero
+        for c in range(3):
+            mc2 = 2 * tile[c, ti, tj, tk]
+            lap = ((tile[c, ti - 1, tj, tk] + tile[c, ti + 1, tj, tk] -
+                    mc2) * ix2 +
+                   (tile[c, ti, tj - 1, tk] + tile[c, ti, tj + 1, tk] -
+                    mc2) * iy2 +
+                   (tile[c, ti, tj, tk - 1] + tile[c, ti, tj, tk + 1] -
+                    mc2) * iz2)
+            if c == 0:
+                curl = curl_x
+            elif c == 1:
+                curl = curl_y
+            else:
+                curl = curl_z
+            H_eff[c, i, j, k] = coef_ex * lap + coef_dmi * curl + H[c]
+
+    @cuda.jit
+    def update_kernel(M, m, Ms, H_eff, beta, lamda, check, diff):
+        # Same update as update_M of Min_Driver, one thread per cell
+        i, j, k = cuda.grid(3)
+        if i >= M.shape[1] or j >= M.shape[2] or k >= M.shape[3]:
+            return
+        Hx, Hy, Hz = H_eff[0, i, j, k], H_eff[1, i, j, k], H_eff[2, i, j, k]
+        H_norm = math.sqrt(Hx * Hx + Hy * Hy + Hz * Hz)
+        # Zero effective field means M should not change
+        if H_norm > 0:
+            # No Temperature (T = 0, beta = inf)
+            if beta == 9e99:
+                L_result = nb_t(1)
+            else:
+                L_result = nb_t(_langevin(beta * mu0 * H_norm))
+            scale = Ms[i, j, k] * L_result / H_norm
+            Mx = M[0, i, j, k] + lamda * (scale * Hx - M[0, i, j, k])
+            My = M[1, i, j, k] + lamda * (scale * Hy - M[1, i, j, k])
+            Mz = M[2, i, j, k] + lamda * (scale * Hz - M[2, i, j, k])
+            ratio = Ms[i, j, k] * abs(L_result) / \
+                math.sqrt(Mx * Mx + My * My + Mz * Mz)
+            M[0, i, j, k] = Mx * ratio
+            M[1, i, j, k] = My * ratio
+            M[2, i, j, k] = Mz * ratio
+        Ms_new = math.sqrt(M[0, i, j, k] ** 2 + M[1, i, j, k] ** 2 +
+                           M[2, i, j, k] ** 2)
+        Ms[i, j, k] = Ms_new
+        local = nb_t(0)
+        for c in range(3):
+            m_new = M[c, i, j, k] / Ms_new if Ms_new > 0 else nb_t(0)
+            local = max(local, abs(m_new - m[c, i, j, k]))
+            m[c, i, j, k] = m_new
+        if check:
+            diff[i, j, k] = local
+
+    _kernels[dtype] = (unit_kernel, field_kernel, update_kernel)
+    return _kernels[dtype]
+
+
+_max_reduce = cuda.reduce(lambda a, b: max(a, b))
+
+
+def _mean_field_cuda(M, H, A, D, beta, lamda, tol, maxiter, check_mask):
+    '''
+    Mean-field iteration on a CUDA device, with the same arguments and
+    result as the compiled CPU loop.
+
+    M is copied to the device once and back once after the iteration,
+    all other fields stay on the device.
+
+    Returns
+    -------
+    int
+        Number of iterations.
+    '''
+    unit_kernel, field_kernel, update_kernel = _get_kernels(M.dtype)
+    t = M.dtype.type
+    nx, ny, nz = M.shape[1], M.shape[2], M.shape[3]
+    threads = (TX, TY, TZ)
+    blocks = (math.ceil(nx / TX), math.ceil(ny / TY), math.ceil(nz / TZ))
+
+    d_M = cuda.to_device(M)
+    d_m = cuda.device_array_like(M)
+    d_Ms = cuda.device_array((nx, ny, nz), M.dtype)
+    d_H_eff = cuda.device_array_like(M)
+    d_diff = cuda.device_array((nx, ny, nz), M.dtype)
+    d_H = cuda.to_device(H)
+    field_args = (t((2 * A) / mu0), t(-((2 * D) / mu0)),
+                  t(1 / dx ** 2), t(1 / dy ** 2), t(1 / dz ** 2),
+                  t(1 / (2 * dx)), t(1 / (2 * dy)), t(1 / (2 * dz)))
+
+    unit_kernel[blocks, threads](d_M, d_m, d_Ms)
+    field_kernel[blocks, threads](d_m, d_Ms, d_H, *field_args, d_H_eff)
+    count = 0
+    while count < maxiter:
+        # update M, m and Ms
+        check = (count & check_mask) == 0
+        update_kernel[blocks, threads](d_M, d_m, d_Ms, d_H_eff, beta,
+                                       t(lamda), check, d_diff)
+        field_kernel[blocks, threads](d_m, d_Ms, d_H, *field_args, d_H_eff)
+        # stop criteria
+        if check and _max_reduce(d_diff.ravel(), init=0) <= tol:
+            break
+        count += 1
+        if (count % 1000 == 0):
+            print(count)
+    d_M.copy_to_host(M)
+    return count
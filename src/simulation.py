@@ -4,6 +4,7 @@ from Energy_Term import Exchange, Zeeman, DMI, M
 from Mean_Field import Min_Driver
 import numpy as np
 import matplotlib.pyplot as plt
+from numba import cuda
 import time
 
 # Some important hyperparameters
@@ -23,11 +24,12 @@ mesh = df.Mesh(region=region, cell=(2.5e-9, 2.5e-9, 2.5e-9))
 m = df.Field(mesh, dim=3, value=[0, 0, -1], norm=Ms)
 system = mm.System(name='skyrmion')
 system.m = m
-m_my = M(system.m.array)
+# Single precision halves the memory traffic of the iteration
+m_my = M(system.m.array, dtype=np.float32)
 
 # Define Energy Terms
-ex = Exchange(A=A)
-dmi = DMI(D=D)
+ex = Exchange(A=A, Ms=Ms)
+dmi = DMI(D=D, Ms=Ms)
 zeeman = Zeeman(H=H)
 
 # Apply Mean-field model
@@ -35,7 +37,8 @@ E_ini = ex.energy(m_my) + zeeman.energy(m_my) + dmi.energy(m_my)
 print("Initial Energy: ", E_ini)
 
 time_start = time.time()
-min_driver = Min_Driver()
+# Run the iteration on a GPU when one is available
+min_driver = Min_Driver(device='cuda' if cuda.is_available() else 'cpu')
 final_M_my, E_end, count = min_driver.Mean_field_difference(m_my)
 M_final = final_M_my.get_M()
 print("Final state of M: ", M_final)
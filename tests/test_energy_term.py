@@ -5,6 +5,7 @@ import oommfc as oc  # noqa: E402
 import discretisedfield as df  # noqa: E402
 import micromagneticmodel as mm  # noqa: E402
 from src.Energy_Term import Exchange, Zeeman, DMI, M  # noqa: E402
+from src.Energy_Term import _lap_kernel, _curl_kernel  # noqa: E402
 
 
 # Some important hyperparameters
@@ -29,6 +30,9 @@ system.energy = (mm.Exchange(A=8.78e-12) +
                  mm.DMI(D=D, crystalclass='T') +
                  mm.Zeeman(H=(0, 0, B / mm.consts.mu0)))
 m_my = M(system.m.array)
+# Seeded field with a saturation magnetization that changes between cells
+rng = np.random.default_rng(0)
+M_pert = system.m.array * (1 + 0.1 * rng.random((*n, 1)))
 ex = Exchange(A=A)
 z = Zeeman(H=H)
 d = DMI(D=D)
@@ -64,6 +68,20 @@ class TestExchange:
         e_my_ex = ex.energy(m_my)
         assert np.allclose(e_u_ex, e_my_ex)
 
+    def test_eff_ex_Ms(self):
+        '''
+            Test effective field with given saturation magnetization
+        '''
+        H_u_eff_ex = oc.compute(system.energy.exchange.effective_field, system)
+        term = Exchange(A=A, Ms=Ms)
+        assert np.allclose(H_u_eff_ex.array, term.effective_field(m_my))
+        # The field follows the Ms of m when it differs from the given one
+        for m_test in (M(0.5 * system.m.array), M(M_pert)):
+            H_test = term.effective_field(m_test)
+            assert np.abs(H_test).max() > 0
+            assert np.allclose(H_test, ex.effective_field(m_test),
+                               rtol=1e-12, atol=0)
+
 
 class TestDMI:
     """
@@ -95,6 +113,20 @@ class TestDMI:
         e_my_d = d.energy(m_my)
         assert np.allclose(e_u_d, e_my_d)
 
+    def test_eff_d_Ms(self):
+        '''
+            Test effective field with given saturation magnetization
+        '''
+        H_u_eff_d = oc.compute(system.energy.dmi.effective_field, system)
+        term = DMI(D=D, Ms=Ms)
+        assert np.allclose(H_u_eff_d.array, term.effective_field(m_my))
+        # The field follows the Ms of m when it differs from the given one
+        for m_test in (M(0.5 * system.m.array), M(M_pert)):
+            H_test = term.effective_field(m_test)
+            assert np.abs(H_test).max() > 0
+            assert np.allclose(H_test, d.effective_field(m_test),
+                               rtol=1e-12, atol=0)
+
 
 class TestZeeman:
     """
@@ -125,3 +157,78 @@ class TestZeeman:
         e_u_z = oc.compute(system.energy.zeeman.energy, system)
         e_my_z = z.energy(m_my)
         assert np.allclose(e_u_z, e_my_z)
+
+
+class TestM:
+    """
+        Test cases for magnetization field class.
+    """
+
+    def test_set_M(self):
+        '''
+            Test cached Ms and m are refreshed after set_M
+        '''
+        m_test = M(system.m.array.copy())
+        m_test.get_m()
+        m_test.set_M(-2 * system.m.array)
+        assert np.allclose(m_test.get_Ms(), 2 * m_my.get_Ms())
+        assert np.allclose(m_test.get_m(), -m_my.get_m())
+
+    def test_cache(self):
+        '''
+            Test m is computed once and only set_M changes it
+        '''
+        m_test = M(system.m.array.copy())
+        m_old = m_test.get_m()
+        assert m_test.get_m() is m_old
+        assert not m_old.flags.writeable
+        m_test.set_M(-system.m.array)
+        assert m_test.get_m() is not m_old
+        assert np.allclose(m_old, m_my.get_m())
+
+    def test_Ms_scalar(self):
+        '''
+            Test uniform saturation magnetization is detected
+        '''
+        assert np.isclose(m_my.get_Ms_scalar(), Ms)
+        m_32 = M(system.m.array, dtype=np.float32)
+        assert np.isclose(m_32.get_Ms_scalar(), Ms, rtol=1e-6)
+        M_test = system.m.array.copy()
+        M_test[0, 0, 0] *= 2
+        assert M(M_test).get_Ms_scalar() is None
+
+    def test_float32(self):
+        '''
+            Test single precision field gives close fields and energies
+        '''
+        m_64 = M(M_pert)
+        m_32 = M(M_pert, dtype=np.float32)
+        assert m_32.get_M().dtype == np.float32
+        for term in (ex, d, z):
+            H_64 = term.effective_field(m_64)
+            H_32 = term.effective_field(m_32)
+            assert H_32.dtype == np.float32
+            assert np.allclose(H_32, H_64, rtol=1e-5,
+                               atol=1e-5 * np.abs(H_64).max())
+            # DMI and zeeman energies cancel between cells, so the
+            # error is compared with the sum of the absolute densities
+            w_abs = np.sum(np.abs(term.energy_density(m_64))) * dx * dy * dz
+            assert abs(term.energy(m_32) - term.energy(m_64)) <= 1e-6 * w_abs
+
+    def test_kernels(self):
+        '''
+            Test component-first kernels of the mean-field loop
+            give exactly the Laplacian and curl of M
+        '''
+        for dtype in (np.float64, np.float32):
+            m_test = M(M_pert, dtype=dtype)
+            t = np.dtype(dtype).type
+            m_soa = np.ascontiguousarray(np.moveaxis(m_test.get_m(), -1, 0))
+            lap = np.empty_like(m_soa)
+            curl = np.empty_like(m_soa)
+            _lap_kernel(m_soa, lap, t(1 / dx ** 2), t(1 / dy ** 2),
+                        t(1 / dz ** 2))
+            _curl_kernel(m_soa, curl, t(1 / (2 * dx)), t(1 / (2 * dy)),
+                         t(1 / (2 * dz)))
+            assert np.array_equal(np.moveaxis(lap, 0, -1), m_test.laplace())
+            assert np.array_equal(np.moveaxis(curl, 0, -1), m_test.curl())
@@ -1,10 +1,14 @@
 import sys
 sys.path.append('.')
 import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from numba import cuda  # noqa: E402
 import discretisedfield as df  # noqa: E402
 import micromagneticmodel as mm  # noqa: E402
 from src.Energy_Term import Exchange, Zeeman, DMI, M  # noqa: E402
-from src.Mean_Field import Min_Driver  # noqa: E402
+import src.Mean_Field as Mean_Field  # noqa: E402
+from src.Mean_Field import Min_Driver, check_interval  # noqa: E402
+from src.Mean_Field import _update_kernel, _field_kernel  # noqa: E402
 
 
 # Some important hyperparameters
@@ -33,6 +37,10 @@ m_my_2 = M(system.m.array)
 ex = Exchange(A=A)
 z = Zeeman(H=H)
 d = DMI(D=D)
+# Seeded field in random directions
+rng = np.random.default_rng(0)
+M_rand = rng.random((*n, 3)) * 2 - 1
+M_rand *= Ms / np.linalg.norm(M_rand, axis=3, keepdims=True)
 
 
 class TestBiStable:
@@ -71,3 +79,113 @@ class TestBiStable:
         M_1, E_1, count_1 = min_driver.Mean_field_difference(m_my_1)
         M_2, E_2, count_2 = min_driver.Mean_field_difference(m_my_2)
         assert E_1 == E_2
+
+
+class TestEffectiveField:
+    '''
+        Compare cal_effective_field with the separate energy terms.
+    '''
+
+    def test_effective_field(self):
+        '''
+        The field and energy should be the sums of the terms,
+        the field is summed in place after the energies are computed.
+        '''
+        m_test = M(M_rand)
+        H_eff, E = Min_Driver().cal_effective_field(m_test)
+        H_sum = (ex.effective_field(m_test) + z.effective_field(m_test) +
+                 d.effective_field(m_test))
+        E_sum = ex.energy(m_test) + z.energy(m_test) + d.energy(m_test)
+        assert np.allclose(H_eff, H_sum, rtol=1e-12, atol=0)
+        assert np.isclose(E, E_sum, rtol=1e-12, atol=0)
+
+    def test_field_kernel(self):
+        '''
+        The compiled field of the mean-field loop should equal
+        the field of cal_effective_field.
+        '''
+        m_test = M(M_rand)
+        H_eff, E = Min_Driver().cal_effective_field(m_test)
+        # The compiled field works on component-first arrays
+        m_arr = np.array(np.moveaxis(m_test.get_m(), -1, 0), order='C')
+        Ms_arr = m_test.get_Ms()[..., 0].copy()
+        lap = np.empty_like(m_arr)
+        curl = np.empty_like(m_arr)
+        H_arr = np.empty_like(m_arr)
+        _field_kernel(m_arr, Ms_arr, np.asarray(H, dtype=float), A, D,
+                      lap, curl, H_arr)
+        # Components can cancel to near zero, so the round-off is
+        # compared with the norm of the field in every cell
+        diff = np.linalg.norm(np.moveaxis(H_arr, 0, -1) - H_eff, axis=3)
+        assert (diff <= 1e-12 * np.linalg.norm(H_eff, axis=3)).all()
+
+
+class TestUpdate:
+    '''
+        Compare update_M with the update of the compiled loop.
+    '''
+
+    @pytest.mark.parametrize('beta', [9e99, 5e3, 0.05])
+    def test_update(self, beta, monkeypatch):
+        '''
+        One step of update_M and of the compiled update should give
+        the same magnetisation, at zero and finite temperature.
+        '''
+        monkeypatch.setattr(Mean_Field, 'beta', beta)
+        m_test = M(M_rand)
+        min_driver = Min_Driver()
+        H_eff, E = min_driver.cal_effective_field(m_test)
+        M_new = min_driver.update_M(m_test, H_eff)
+        # The compiled update works in place on component-first arrays
+        M_arr = np.array(np.moveaxis(m_test.get_M(), -1, 0), order='C')
+        m_arr = np.array(np.moveaxis(m_test.get_m(), -1, 0), order='C')
+        Ms_arr = m_test.get_Ms()[..., 0].copy()
+        H_arr = np.array(np.moveaxis(H_eff, -1, 0), order='C')
+        _update_kernel(M_arr, m_arr, Ms_arr, H_arr, beta, 0.005, False)
+        assert np.allclose(M_new, np.moveaxis(M_arr, 0, -1),
+                           rtol=1e-9, atol=1e-9 * Ms)
+
+
+class TestLangevin:
+    '''
+        Test the Langevin function at small, usual and large inputs.
+    '''
+
+    def test_langevin(self):
+        '''
+        Small inputs follow the series x / 3 - x ** 3 / 45,
+        large inputs approach 1 and the usual range matches
+        coth(x) - 1 / x, in double and single precision.
+        '''
+        min_driver = Min_Driver()
+        x = np.array([0.0, 1e-9, 1e-5, 1.0, 3.0, 50.0])
+        L = min_driver.Langevin(x)
+        assert np.allclose(L[:3], x[:3] / 3 - x[:3] ** 3 / 45,
+                           rtol=1e-12, atol=0)
+        assert np.allclose(L[3:5], 1 / np.tanh(x[3:5]) - 1 / x[3:5],
+                           rtol=1e-12, atol=0)
+        assert np.isclose(L[5], 1 - 1 / 50, rtol=1e-12, atol=0)
+        L_32 = min_driver.Langevin(x.astype(np.float32))
+        assert L_32.dtype == np.float32
+        assert np.allclose(L_32, L, rtol=1e-6, atol=0)
+
+
+@pytest.mark.skipif(not cuda.is_available(), reason='no CUDA device')
+class TestCUDA:
+    '''
+        Compare the CUDA mean-field iteration with the CPU one.
+    '''
+
+    def test_cuda(self):
+        '''
+        The final energy and magnetisation should agree
+        up to the round-off of the two devices, which can move
+        the stop by at most one convergence check.
+        '''
+        M_1, E_1, count_1 = Min_Driver().Mean_field_difference(
+            M(system.m.array))
+        M_2, E_2, count_2 = Min_Driver(device='cuda').Mean_field_difference(
+            M(system.m.array))
+        assert abs(count_1 - count_2) <= check_interval
+        assert np.isclose(E_1, E_2, rtol=1e-6, atol=0)
+        assert np.allclose(M_1.get_M(), M_2.get_M(), atol=1e-3 * Ms)